@@ -1,15 +1,30 @@
-import os
+import asyncio
 from typing import Any, Callable
 import traceback
 from browsergym.experiments import Agent
 from browsergym.experiments.agent import AgentInfo
-from langchain.schema import HumanMessage, SystemMessage
-from langchain_openai import ChatOpenAI
+from browsergym.utils.obs import (
+    flatten_axtree_to_str,
+    flatten_dom_to_str,
+    prune_html,
+)
 
-from .llm_utils import DEFAULT_MODEL, ParseError, retry
-from . import dynamic_prompting
+from .llm_utils import (
+    DEFAULT_MODEL,
+    ParseError,
+    aretry,
+    count_tokens,
+    get_shared_openai_client,
+    run_sync,
+)
+from . import dynamic_prompting, prompt_history
 from .dynamic_prompting import Flags
 
+# An answer this long that has none of the answer tags is not going to
+# parse, so it is cut short and `aretry` asks again right away.
+NO_TAG_ABORT_CHARS = 2000
+ANSWER_TAGS = ("<think>", "<memory>", "<action>")
+
 
 class WebResearchAgent(Agent):
     """
@@ -18,23 +33,46 @@ class WebResearchAgent(Agent):
     """
 
     def __init__(self, goal: str, flags: Flags,
-                 model_name: str = DEFAULT_MODEL) -> None:
+                 model_name: str = DEFAULT_MODEL,
+                 n_first_samples: int = 1) -> None:
         super().__init__()
         self.goal = goal
         self.flags = flags
         self.model_name = model_name
-        self.chat_llm = ChatOpenAI(
-            model_name=DEFAULT_MODEL,
-            api_key=os.getenv("OPENAI_API_KEY"),
-            temperature=0.1,
-            max_tokens=2000,
-        )
+        # more than one concurrent first sample sends the whole prompt that
+        # many times, and needs a higher temperature to be worth it
+        self.n_first_samples = n_first_samples
+        self.temperature = 0.1 if n_first_samples == 1 else 0.7
         self.action_set = dynamic_prompting.get_action_space(flags)
-        self.obs_history = []
+        # Identical at every step, so it is sent first to benefit from the
+        # provider's prompt-prefix caching.
+        self._static_prefix = dynamic_prompting.StaticPrompt(flags).prompt
+        self._static_prefix_tokens = count_tokens(
+            self._static_prefix, model=model_name
+        )
+        # only the previous observation is needed, to diff it with the next
+        # one; older ones (screenshot, DOM...) are not kept alive
+        self._last_obs = None
+        self.history_steps: list[prompt_history.HistoryStep] = []
         self.actions = []
         self.memories = []
         self.thoughts = []
 
+    def obs_preprocessor(self, obs: dict) -> dict:
+        """
+        Add the flattened accessibility tree and the pruned HTML to `obs`.
+        The pruned HTML is skipped entirely when `flags.use_html` is off.
+        """
+        obs = dict(obs)
+        obs["axtree_txt"] = flatten_axtree_to_str(obs["axtree_object"])
+        if self.flags.use_html:
+            obs["pruned_html"] = prune_html(
+                flatten_dom_to_str(obs["dom_object"])
+            )
+        else:
+            obs["pruned_html"] = None
+        return obs
+
     def create_parser(
         self, main_prompt: dynamic_prompting.MainPrompt
     ) -> Callable[[Any], tuple[dict, bool, str]]:
@@ -43,39 +81,134 @@ class WebResearchAgent(Agent):
                 ans_dict = main_prompt.parse_answer(text)
             except ParseError as e:
                 # these parse errors will be caught by the retry function and
-                # the chat_llm will have a chance to recover
+                # the LLM will have a chance to recover
                 return None, False, str(e)
 
             return ans_dict, True, ""
         return parser
 
+    def create_tail_only_retry(
+        self, main_prompt: dynamic_prompting.MainPrompt
+    ) -> Callable[[str], bool]:
+        def has_valid_action(text):
+            # the action is fine, only the rest of the format needs fixing,
+            # which doesn't need the observation
+            try:
+                main_prompt.action_space.parse_answer(text)
+            except ParseError:
+                return False
+            return True
+        return has_valid_action
+
+    async def chat(self, messages: list[dict]) -> str:
+        """
+        Stream the answer, so generation can stop as soon as it is clearly
+        not following the answer format. Closing the stream stops the
+        generation. This includes samples that `aretry` cancels once it no
+        longer needs them: it awaits them, so their stream is closed before
+        the step returns.
+        """
+        # the client of the thread running the step, its connections are
+        # bound to that thread's event loop
+        openai = get_shared_openai_client()
+        stream = await openai.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            temperature=self.temperature,
+            max_tokens=2000,
+            stream=True,
+        )
+        parts: list[str] = []
+        length = 0
+        checked = False
+        try:
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                parts.append(chunk.choices[0].delta.content)
+                length += len(parts[-1])
+                if not checked and length >= NO_TAG_ABORT_CHARS:
+                    checked = True
+                    text = "".join(parts)
+                    if not any(tag in text for tag in ANSWER_TAGS):
+                        break
+        finally:
+            await stream.close()
+        return "".join(parts)
+
     def get_action(self, obs: Any) -> tuple[str, AgentInfo]:
         """
         For a description of `obs`, please see the get_action method
         in the superclass
         """
-        self.obs_history.append(obs)
+        return run_sync(self.aget_action(obs))
+
+    @classmethod
+    def get_actions_batch(
+        cls, agents: list["WebResearchAgent"], obs_list: list[Any],
+        max_concurrency: int = 8,
+    ) -> list[tuple[str, AgentInfo]]:
+        """
+        Get the next action of several agents at once, for harnesses that
+        step many environments in lockstep. The LLM requests of up to
+        `max_concurrency` agents are in flight concurrently instead of one
+        after the other, which keeps a large batch within the API rate
+        limits. Rate limit errors are still waited out by `aretry`.
+        """
+        async def gather_actions():
+            semaphore = asyncio.Semaphore(max_concurrency)
+
+            async def get_action(agent, obs):
+                async with semaphore:
+                    return await agent.aget_action(obs)
+
+            return await asyncio.gather(*(
+                get_action(agent, obs)
+                for agent, obs in zip(agents, obs_list, strict=True)
+            ))
+        return list(run_sync(gather_actions()))
+
+    async def aget_action(self, obs: Any) -> tuple[str, AgentInfo]:
+        """
+        Async version of `get_action`, for callers that already run an
+        event loop.
+        """
+        if self._last_obs is not None:
+            # diff the previous observation once, instead of rebuilding the
+            # whole history on every step
+            self.history_steps.append(
+                prompt_history.HistoryStep(
+                    self._last_obs,
+                    obs,
+                    self.actions[-1],
+                    self.memories[-1],
+                    self.flags,
+                )
+            )
+        self._last_obs = obs
         main_prompt = dynamic_prompting.MainPrompt(
-            self.obs_history,
-            self.actions,
-            self.memories,
+            obs,
+            prompt_history.History(self.history_steps, self.flags),
             self.flags
         )
-        sys_msg = dynamic_prompting.SystemPrompt().prompt
         prompt = dynamic_prompting.fit_tokens(
             main_prompt,
-            max_prompt_tokens=128000,
+            max_prompt_tokens=128000 - self._static_prefix_tokens,
             model_name=self.model_name,
         )
 
         chat_messages = [
-            SystemMessage(content=sys_msg),
-            HumanMessage(content=prompt),
+            {"role": "system", "content": self._static_prefix},
+            {"role": "user", "content": prompt},
         ]
 
         parser = self.create_parser(main_prompt)
         try:
-            ans_dict = retry(self.chat_llm, chat_messages, 4, parser)
+            ans_dict = await aretry(
+                self.chat, chat_messages, 4, parser,
+                n_first_samples=self.n_first_samples,
+                tail_only_retry=self.create_tail_only_retry(main_prompt),
+            )
         except ValueError as e:
             ans_dict = {
                 "action": None,
@@ -1,6 +1,8 @@
 import abc
+import bisect
 from dataclasses import dataclass
-import difflib
+import functools
+import itertools
 import logging
 import platform
 from textwrap import dedent
@@ -12,6 +14,8 @@ from browsergym.core.action.highlevel import (
 from browsergymagent.llm_utils import (
     DEFAULT_MODEL,
     count_tokens,
+    extract_html_tags,
+    get_tokenizer,
     image_to_jpg_base64_url,
     parse_html_tags_raise,
     ParseError
@@ -19,6 +23,13 @@ from browsergymagent.llm_utils import (
 
 logger = logging.getLogger(__name__)
 
+# Screenshots are scaled down to this size before being sent, unless the
+# action space uses coordinates, which refer to the full size screenshot.
+SCREENSHOT_MAX_SIZE = 1024
+
+# the host OS doesn't change while we run, look it up once
+_IS_DARWIN = platform.system() == "Darwin"
+
 
 @dataclass
 class Flags:
@@ -32,11 +43,15 @@ class Flags:
     use_past_error_logs: bool = True
     use_action_history: bool = True
     use_diff: bool = False
+    be_cautious: bool = True
     multi_actions: bool = True
     action_space: Literal[
         "bid", "coord", "bid+coord", "bid+nav", "coord+nav",
         "bid+coord+nav"
     ] = "bid"
+    # detail level of the screenshot for the vision model, "low" costs a
+    # fixed, small number of tokens but can't read fine text
+    screenshot_detail: Literal["auto", "low", "high"] = "auto"
 
 
 class PromptElement(abc.ABC):
@@ -45,7 +60,11 @@ class PromptElement(abc.ABC):
     Prompt elements are used to build the prompt. Use flags to control which
     prompt elements are visible. We use class attributes as a convenient way
     to implement static prompts, but feel free to override them with instance
-    attributes or @property decorator."""
+    attributes or @property decorator. Prompt elements are created many times
+    per step, so they use __slots__: subclasses must declare the instance
+    attributes they set, including `_prompt` if it is assigned."""
+
+    __slots__ = ("_visible", "_token_count")
 
     _prompt = ""
     _abstract_ex = ""
@@ -62,11 +81,30 @@ class PromptElement(abc.ABC):
             flag changes during a shrink iteration.
         """
         self._visible = visible
+        self._token_count = None
 
     @property
     def prompt(self):
         """Avoid overriding this method. Override _prompt instead."""
-        return self._hide(self._prompt)
+        # _prompt is only evaluated when visible, so composite or lazily
+        # rendered elements don't do any work when hidden
+        if not self.is_visible:
+            return ""
+        return self._prompt
+
+    def prompt_segments(self) -> list[str]:
+        """The text of `prompt` as a list of strings, to be joined only once
+        by the caller.
+
+        Avoid overriding this method. Composite elements override
+        _prompt_segments instead.
+        """
+        if not self.is_visible:
+            return []
+        return self._prompt_segments()
+
+    def _prompt_segments(self) -> list[str]:
+        return [self._prompt]
 
     @property
     def abstract_ex(self):
@@ -77,7 +115,9 @@ class PromptElement(abc.ABC):
 
         Avoid overriding this method. Override _abstract_ex instead
         """
-        return self._hide(self._abstract_ex)
+        if not self.is_visible:
+            return ""
+        return self._abstract_ex
 
     @property
     def concrete_ex(self):
@@ -88,7 +128,9 @@ class PromptElement(abc.ABC):
 
         Avoid overriding this method. Override _concrete_ex instead
         """
-        return self._hide(self._concrete_ex)
+        if not self.is_visible:
+            return ""
+        return self._concrete_ex
 
     @property
     def is_visible(self):
@@ -98,12 +140,24 @@ class PromptElement(abc.ABC):
             visible = visible()
         return visible
 
-    def _hide(self, value):
-        """Return value if visible is True, else return empty string."""
-        if self.is_visible:
-            return value
-        else:
-            return ""
+    def token_count(self, model_name=DEFAULT_MODEL) -> int:
+        """Number of tokens in the text of this prompt element.
+
+        The count is cached, so shrinking only re-counts the elements whose
+        content actually changed. Elements that change their own prompt must
+        call `_invalidate_token_count`. Composite elements override this to
+        sum the counts of their children without caching, so they never go
+        stale.
+        """
+        if self._token_count is None or self._token_count[0] != model_name:
+            self._token_count = (model_name, self._count_tokens(model_name))
+        return self._token_count[1]
+
+    def _count_tokens(self, model_name) -> int:
+        return count_tokens(self.prompt, model=model_name)
+
+    def _invalidate_token_count(self) -> None:
+        self._token_count = None
 
     def _parse_answer(self, _text_answer) -> dict:
         return {}
@@ -116,8 +170,10 @@ class PromptElement(abc.ABC):
 
 
 class Shrinkable(PromptElement, abc.ABC):
+    __slots__ = ()
+
     @abc.abstractmethod
-    def shrink(self) -> None:
+    def shrink(self, model_name=DEFAULT_MODEL) -> int:
         """Implement shrinking of this prompt element.
 
         You need to recursively call all shrinkable elements that are part of
@@ -125,33 +181,115 @@ class Shrinkable(PromptElement, abc.ABC):
         prompt.
         Shrinking is can be called multiple times to progressively shrink the
         prompt until it fits max_tokens. Default max shrink iterations is 20.
+        Leaf elements must call `_invalidate_token_count` whenever their
+        prompt may have changed.
+
+        Return the number of tokens removed from the prompt, so `fit_tokens`
+        can keep a running total instead of recounting the whole tree.
         """
 
+    def trunkaters(self) -> list["Trunkater"]:
+        """The visible Trunkater elements that are part of this prompt, which
+        `fit_tokens` can truncate directly, in the order they should be
+        truncated."""
+        return []
+
 
 class Trunkater(Shrinkable):
+    """Shrinkable element that drops a fraction of its trailing lines on each
+    shrink, once `start_trunkate_iteration` shrinks have been requested.
+
+    Subclasses implement `_render`. The text is only rendered when the
+    element is visible, it is split into lines only once, on the first
+    truncation, and shrinking just lowers the number of lines kept.
+    """
+
+    __slots__ = (
+        "shrink_speed", "start_trunkate_iteration", "shrink_calls", "_text",
+        "_lines", "_kept",
+    )
+
     def __init__(self, visible, shrink_speed=0.3, start_trunkate_iteration=10):
         super().__init__(visible=visible)
         self.shrink_speed = shrink_speed
         self.start_trunkate_iteration = start_trunkate_iteration
         self.shrink_calls = 0
-        self.deleted_lines = 0
+        self._text: str | None = None
+        self._lines: list[str] | None = None
+        self._kept = 0
+
+    @abc.abstractmethod
+    def _render(self) -> str:
+        """Return the full, untruncated text of this element."""
+
+    @property
+    def _full_text(self) -> str:
+        if self._text is None:
+            self._text = self._render()
+        return self._text
+
+    @property
+    def deleted_lines(self) -> int:
+        if self._lines is None:
+            return 0
+        return len(self._lines) - self._kept
 
-    def shrink(self) -> None:
+    def shrink(self, model_name=DEFAULT_MODEL) -> int:
+        dropped = 0
         if (
             self.is_visible
             and self.shrink_calls >= self.start_trunkate_iteration
         ):
+            before = self.token_count(model_name)
+            self._split_lines()
             # remove the fraction of _prompt
-            lines = self._prompt.splitlines()
-            new_line_count = int(len(lines) * (1 - self.shrink_speed))
-            self.deleted_lines += len(lines) - new_line_count
-            self._prompt = "\n".join(lines[:new_line_count])
-            self._prompt += (
-                f"\n... Deleted {self.deleted_lines} lines to reduce "
-                "prompt size."
-            )
+            self._kept = int(self._kept * (1 - self.shrink_speed))
+            self._invalidate_token_count()
+            dropped = before - self.token_count(model_name)
 
         self.shrink_calls += 1
+        return dropped
+
+    def shrink_to(self, max_tokens: int, model_name=DEFAULT_MODEL) -> int:
+        """Keep the longest run of leading lines that fits `max_tokens`, in
+        a single step. Return the number of tokens dropped."""
+        before = self.token_count(model_name)
+        if before <= max_tokens:
+            return 0
+        self._split_lines()
+        # token counts of the first k lines, with their newline, encoded in
+        # one batch
+        encoded = get_tokenizer(model_name).encode_ordinary_batch(self._lines)
+        prefix_sums = list(itertools.accumulate(
+            (len(line) + 1 for line in encoded), initial=0
+        ))
+        # leave room for the longest footer this element could get
+        budget = max_tokens - count_tokens(
+            self._footer(len(self._lines)), model=model_name
+        )
+        self._kept = max(0, bisect.bisect_right(prefix_sums, budget) - 1)
+        self._invalidate_token_count()
+        return before - self.token_count(model_name)
+
+    def _split_lines(self) -> None:
+        if self._lines is None:
+            self._lines = self._full_text.splitlines()
+            self._kept = len(self._lines)
+
+    def trunkaters(self) -> list["Trunkater"]:
+        return [self] if self.is_visible else []
+
+    @property
+    def _prompt(self) -> str:
+        if self._lines is None:
+            return self._full_text
+        return "\n".join(self._lines[:self._kept]) + self._footer(
+            self.deleted_lines
+        )
+
+    @staticmethod
+    def _footer(deleted_lines: int) -> str:
+        return f"\n... Deleted {deleted_lines} lines to reduce prompt size."
 
 
 def fit_tokens(
@@ -181,58 +319,111 @@ def fit_tokens(
     if max_prompt_tokens is None:
         return shrinkable.prompt
 
+    # every token is at least one byte, so a prompt whose utf-8 encoding fits
+    # the budget fits without running the tokenizer at all
+    prompt = shrinkable.prompt
+    if _utf8_length(prompt) <= max_prompt_tokens:
+        return prompt
+
+    if shrinkable.token_count(model_name) > max_prompt_tokens:
+        _truncate_to_budget(shrinkable, max_prompt_tokens, model_name)
+
+    n_token = shrinkable.token_count(model_name)
     for _ in range(max_iterations):
-        prompt = shrinkable.prompt
-        if isinstance(prompt, str):
-            prompt_str = prompt
-        elif isinstance(prompt, list):
-            prompt_str = "\n".join(
-                [p["text"] for p in prompt if p["type"] == "text"]
-            )
-        else:
-            raise ValueError(f"Unrecognized type for prompt: {type(prompt)}")
-        n_token = count_tokens(prompt_str, model=model_name)
         if n_token <= max_prompt_tokens:
-            return prompt
-        shrinkable.shrink()
+            return shrinkable.prompt
+        # only the elements that changed are recounted
+        n_token -= shrinkable.shrink(model_name)
 
     logger.info(
         dedent(
             f"After {max_iterations} shrink iterations, the prompt is still "
-            f"{count_tokens(prompt_str)} tokens (greater than "
+            f"{n_token} tokens (greater than "
             f"{max_prompt_tokens}). Returning the prompt as is."
         )
     )
-    return prompt
+    return shrinkable.prompt
+
+
+def _utf8_length(prompt) -> int:
+    """Length in bytes of the text of a prompt, ignoring images."""
+    if isinstance(prompt, str):
+        texts = [prompt]
+    else:
+        texts = [part["text"] for part in prompt if part["type"] == "text"]
+    return sum(
+        len(text) if text.isascii() else len(text.encode()) for text in texts
+    )
+
+
+def _truncate_to_budget(shrinkable: Shrinkable, max_prompt_tokens, model_name):
+    """Cut the Trunkater elements of `shrinkable`, each in a single step, to
+    the tokens left by the rest of the prompt. This usually makes the prompt
+    fit without going through the shrink iterations.
+
+    The rest of the prompt can't be truncated, so it is counted only once.
+    Elements are cut in priority order: each one is cut to what the later
+    ones leave, and the later ones are only cut if that is not enough.
+    """
+    trunkaters = shrinkable.trunkaters()
+    counts = [trunkater.token_count(model_name) for trunkater in trunkaters]
+    fixed_tokens = shrinkable.token_count(model_name) - sum(counts)
+    budget = max_prompt_tokens - fixed_tokens
+    for i, trunkater in enumerate(trunkaters):
+        left = budget - sum(counts[i + 1:])
+        if counts[i] <= left:
+            break
+        dropped = trunkater.shrink_to(left, model_name)
+        budget -= counts[i] - dropped
 
 
 class HTML(Trunkater):
+    __slots__ = ("html", "prefix")
+
     def __init__(self, html, visible: bool = True, prefix="") -> None:
         super().__init__(visible=visible, start_trunkate_iteration=5)
-        self._prompt = f"\n{prefix}HTML:\n{html}\n"
+        self.html = html
+        self.prefix = prefix
+
+    def _render(self) -> str:
+        return f"\n{self.prefix}HTML:\n{self.html}\n"
 
 
 class AXTree(Trunkater):
+    __slots__ = ("ax_tree", "coord_type", "prefix")
+
     def __init__(self, ax_tree, visible: bool = True,
                  coord_type=None, prefix="") -> None:
         super().__init__(visible=visible, start_trunkate_iteration=10)
-        if coord_type == "center":
+        self.ax_tree = ax_tree
+        self.coord_type = coord_type
+        self.prefix = prefix
+
+    def _render(self) -> str:
+        if self.coord_type == "center":
             coord_note = """\
 Note: center coordinates are provided in parenthesis and are
   relative to the top left corner of the page.\n\n"""
-        elif coord_type == "box":
+        elif self.coord_type == "box":
             coord_note = """\
 Note: bounding box of each object are provided in parenthesis and are
   relative to the top left corner of the page.\n\n"""
         else:
             coord_note = ""
-        self._prompt = f"\n{prefix}AXTree:\n{coord_note}{ax_tree}\n"
+        return f"\n{self.prefix}AXTree:\n{coord_note}{self.ax_tree}\n"
 
 
 class Error(PromptElement):
+    __slots__ = ("error", "prefix")
+
     def __init__(self, error, visible: bool = True, prefix="") -> None:
         super().__init__(visible=visible)
-        self._prompt = f"\n{prefix}Error from previous action:\n{error}\n"
+        self.error = error
+        self.prefix = prefix
+
+    @property
+    def _prompt(self) -> str:
+        return f"\n{self.prefix}Error from previous action:\n{self.error}\n"
 
 
 class Observation(Shrinkable):
@@ -241,6 +432,10 @@ class Observation(Shrinkable):
     Contains the html, the accessibility tree and the error logs.
     """
 
+    __slots__ = (
+        "flags", "obs", "html", "ax_tree", "error", "_screenshot_url"
+    )
+
     def __init__(self, obs, flags: Flags) -> None:
         super().__init__(visible=True)
         self.flags = flags
@@ -259,30 +454,66 @@ class Observation(Shrinkable):
             visible=flags.use_error_logs and obs["last_action_error"],
             prefix="## ",
         )
+        self._screenshot_url = None
 
-    def shrink(self):
-        self.ax_tree.shrink()
-        self.html.shrink()
+    def shrink(self, model_name=DEFAULT_MODEL) -> int:
+        return self.ax_tree.shrink(model_name) + self.html.shrink(model_name)
+
+    def trunkaters(self) -> list[Trunkater]:
+        # the AXTree is what actions refer to, the HTML goes first
+        return self.html.trunkaters() + self.ax_tree.trunkaters()
 
     @property
     def _prompt(self) -> str:
+        return "".join(self._prompt_segments())
+
+    def _prompt_segments(self) -> list[str]:
+        return [
+            "\n# Observation of current step:\n",
+            *self.html.prompt_segments(),
+            *self.ax_tree.prompt_segments(),
+            *self.error.prompt_segments(),
+            "\n\n",
+        ]
+
+    def token_count(self, model_name=DEFAULT_MODEL) -> int:
         return (
-            f"\n# Observation of current step:\n"
-            f"{self.html.prompt}{self.ax_tree.prompt}{self.error.prompt}\n\n"
+            count_tokens(
+                "\n# Observation of current step:\n\n\n", model=model_name
+            )
+            + self.html.token_count(model_name)
+            + self.ax_tree.token_count(model_name)
+            + self.error.token_count(model_name)
         )
 
     def add_screenshot(self, prompt):
         if self.flags.use_screenshot:
             if isinstance(prompt, str):
                 prompt = [{"type": "text", "text": prompt}]
-            img_url = image_to_jpg_base64_url(self.obs["screenshot"])
-            prompt.append({"type": "image_url", "image_url": {"url": img_url}})
+            if self._screenshot_url is None:
+                # encoded once, the prompt can be rendered several times
+                if "coord" in self.flags.action_space:
+                    max_size = None
+                else:
+                    max_size = SCREENSHOT_MAX_SIZE
+                self._screenshot_url = image_to_jpg_base64_url(
+                    self.obs["screenshot"], max_size=max_size
+                )
+            prompt.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": self._screenshot_url,
+                    "detail": self.flags.screenshot_detail,
+                },
+            })
         return prompt
 
 
 class MacNote(PromptElement):
+    __slots__ = ("_prompt",)
+
     def __init__(self) -> None:
-        super().__init__(visible=platform.system() == "Darwin")
+        super().__init__(visible=_IS_DARWIN)
         self._prompt = (
             "\nNote: you are on mac so you should use Meta instead of Control "
             "for Control+C etc.\n"
@@ -290,6 +521,8 @@ class MacNote(PromptElement):
 
 
 class BeCautious(PromptElement):
+    __slots__ = ("_prompt",)
+
     def __init__(self, visible: bool = True) -> None:
         super().__init__(visible=visible)
         self._prompt = (
@@ -304,6 +537,8 @@ class BeCautious(PromptElement):
 
 
 class GoalInstructions(PromptElement):
+    __slots__ = ("_prompt",)
+
     def __init__(self, goal, visible: bool = True) -> None:
         super().__init__(visible)
         self._prompt = f"""\
@@ -318,6 +553,8 @@ and executed by a program, make sure to follow the formatting instructions.
 
 
 class ChatInstructions(PromptElement):
+    __slots__ = ("_prompt",)
+
     def __init__(self, chat_messages, visible: bool = True) -> None:
         super().__init__(visible)
         self._prompt = """\
@@ -347,6 +584,8 @@ to follow the formatting instructions.
 
 
 class SystemPrompt(PromptElement):
+    __slots__ = ()
+
     _prompt = """\
 You are an agent trying to solve a web task based on the content of the page
 and a user instructions. You can interact with the page and explore. Each
@@ -355,7 +594,16 @@ a new page."""
 
 
 def get_action_space(flags: Flags) -> AbstractActionSet:
-    match flags.action_space:
+    """Return the action set for these flags. The action set is shared
+    between all callers using the same flags."""
+    return _get_action_set(flags.action_space, flags.multi_actions)
+
+
+@functools.lru_cache(maxsize=16)
+def _get_action_set(
+    action_space: str, multi_actions: bool
+) -> AbstractActionSet:
+    match action_space:
         case "bid":
             action_subsets = ["chat", "bid"]
         case "coord":
@@ -370,37 +618,56 @@ def get_action_space(flags: Flags) -> AbstractActionSet:
             action_subsets = ["chat", "bid", "coord", "nav"]
         case _:
             raise NotImplementedError(
-                f"Unknown action_space {repr(flags.action_space)}"
+                f"Unknown action_space {repr(action_space)}"
             )
 
-    action_space = HighLevelActionSet(
+    return HighLevelActionSet(
         subsets=action_subsets,
-        multiaction=flags.multi_actions,
+        multiaction=multi_actions,
         strict=False,
         demo_mode="off",
     )
 
-    return action_space
+
+@functools.lru_cache(maxsize=16)
+def _describe_action_space(
+    action_space: str, multi_actions: bool
+) -> tuple[str, str, str]:
+    """Return the description, the abstract example and the concrete example
+    of an action set. These are pure functions of the flags but expensive to
+    format, so they are computed once."""
+    action_set = _get_action_set(action_space, multi_actions)
+    return (
+        action_set.describe(),
+        action_set.example_action(abstract=True),
+        action_set.example_action(abstract=False),
+    )
 
 
 class ActionSpace(PromptElement):
+    __slots__ = (
+        "flags", "action_space", "_prompt", "_abstract_ex", "_concrete_ex"
+    )
+
     def __init__(self, flags: Flags) -> None:
         super().__init__()
         self.flags = flags
         self.action_space = get_action_space(flags)
-
-        self._prompt = (
-            f"# Action space:\n{self.action_space.describe()}"
-            f"{MacNote().prompt}\n"
+        description, abstract_ex, concrete_ex = _describe_action_space(
+            flags.action_space, flags.multi_actions
         )
+
+        # the note can only be visible on mac, don't build it elsewhere
+        mac_note = MacNote().prompt if _IS_DARWIN else ""
+        self._prompt = f"# Action space:\n{description}{mac_note}\n"
         self._abstract_ex = f"""
 <action>
-{self.action_space.example_action(abstract=True)}
+{abstract_ex}
 </action>
 """
         self._concrete_ex = f"""
 <action>
-{self.action_space.example_action(abstract=False)}
+{concrete_ex}
 </action>
 """
 
@@ -423,6 +690,8 @@ class ActionSpace(PromptElement):
 
 
 class Memory(PromptElement):
+    __slots__ = ()
+
     _prompt = ""  # provided in the abstract and concrete examples
 
     _abstract_ex = """
@@ -445,6 +714,8 @@ focusable for elements of the form at next step.
 
 
 class Thought(PromptElement):
+    __slots__ = ()
+
     _prompt = ""
 
     _abstract_ex = """
@@ -468,173 +739,78 @@ the form is not visible yet or some fields are disabled. I need to replan.
         )
 
 
-def diff(previous, new):
-    """Return a string showing the difference between original and new.
-
-    If the difference is above diff_threshold, return the diff string."""
-
-    if previous == new:
-        return "Identical", []
-
-    if len(previous) == 0 or previous is None:
-        return "previous is empty", []
-
-    diff_gen = difflib.ndiff(previous.splitlines(), new.splitlines())
-
-    diff_lines = []
-    plus_count = 0
-    minus_count = 0
-    for line in diff_gen:
-        if line.strip().startswith("+"):
-            diff_lines.append(line)
-            plus_count += 1
-        elif line.strip().startswith("-"):
-            diff_lines.append(line)
-            minus_count += 1
-        else:
-            continue
-
-    header = f"{plus_count} lines added and {minus_count} lines removed:"
+class StaticPrompt(PromptElement):
+    """The part of the prompt that stays identical at every step.
 
-    return header, diff_lines
+    This holds the system prompt, the action space and the answer examples.
+    It is meant to be sent as a separate leading message so that the
+    provider's prompt-prefix cache can reuse it across steps.
+    """
 
+    __slots__ = ("_prompt",)
 
-class Diff(Shrinkable):
-    def __init__(
-        self, previous, new, prefix="", max_line_diff=20,
-        shrink_speed=2, visible=True
-    ) -> None:
-        super().__init__(visible=visible)
-        self.max_line_diff = max_line_diff
-        self.header, self.diff_lines = diff(previous, new)
-        self.shrink_speed = shrink_speed
-        self.prefix = prefix
+    _abstract_ex_header = """
+# Abstract Example
 
-    def shrink(self):
-        self.max_line_diff -= self.shrink_speed
-        self.max_line_diff = max(1, self.max_line_diff)
+Here is an abstract version of the answer with description of the content of
+each tag. Make sure you follow this structure, but replace the content with
+your answer:
+"""
 
-    @property
-    def _prompt(self) -> str:
-        diff_str = "\n".join(self.diff_lines[: self.max_line_diff])
-        if len(self.diff_lines) > self.max_line_diff:
-            original_count = len(self.diff_lines)
-            diff_str = (
-                f"{diff_str}\nDiff truncated, "
-                f"{original_count - self.max_line_diff} changes now shown."
-            )
-        return f"{self.prefix}{self.header}\n{diff_str}\n"
+    _concrete_ex_header = """
+# Concrete Example
 
+Here is a concrete example of how to format your answer.
+Make sure to follow the template with proper tags:
+"""
 
-class HistoryStep(Shrinkable):
-    def __init__(
-        self, previous_obs, current_obs, action, memory, flags: Flags,
-        shrink_speed=1
-    ) -> None:
+    def __init__(self, flags: Flags) -> None:
         super().__init__()
-        self.html_diff = Diff(
-            previous_obs[flags.html_type],
-            current_obs[flags.html_type],
-            prefix="\n### HTML diff:\n",
-            shrink_speed=shrink_speed,
-            visible=flags.use_html and flags.use_diff,
-        )
-        self.ax_tree_diff = Diff(
-            previous_obs["axtree_txt"],
-            current_obs["axtree_txt"],
-            prefix="\n### Accessibility tree diff:\n",
-            shrink_speed=shrink_speed,
-            visible=flags.use_ax_tree and flags.use_diff,
-        )
-        self.error = Error(
-            current_obs["last_action_error"],
-            visible=(
-                lambda: flags.use_error_logs
-                and current_obs["last_action_error"]
-                and flags.use_past_error_logs
-            ),
-            prefix="### ",
-        )
-        self.shrink_speed = shrink_speed
-        self.action = action
-        self.memory = memory
-        self.flags = flags
-
-    def shrink(self):
-        super().shrink()
-        self.html_diff.shrink()
-        self.ax_tree_diff.shrink()
-
-    @property
-    def _prompt(self) -> str:
-        prompt = ""
-
-        if self.flags.use_action_history:
-            prompt += f"\n### Action:\n{self.action}\n"
-
-        prompt += (
-            f"{self.error.prompt}{self.html_diff.prompt}"
-            f"{self.ax_tree_diff.prompt}"
-        )
-
-        if self.flags.use_memory and self.memory is not None:
-            prompt += f"\n### Memory:\n{self.memory}\n"
-
-        return prompt
-
-
-class History(Shrinkable):
-    def __init__(
-        self, history_obs, actions, memories, flags: Flags, shrink_speed=1
-    ) -> None:
-        super().__init__(visible=lambda: flags.use_history)
-        assert len(history_obs) == len(actions) + 1
-        assert len(history_obs) == len(memories) + 1
+        action_space = ActionSpace(flags)
+        thought = Thought(visible=flags.use_thought)
+        memory = Memory(visible=flags.use_memory)
+        self._prompt = f"""\
+{SystemPrompt().prompt}
+{BeCautious(visible=flags.be_cautious).prompt}
+{action_space.prompt}\
+{thought.prompt}\
+{memory.prompt}\
+{self._abstract_ex_header}\
+{thought.abstract_ex}\
+{memory.abstract_ex}\
+{action_space.abstract_ex}\
+{self._concrete_ex_header}\
+{thought.concrete_ex}\
+{memory.concrete_ex}\
+{action_space.concrete_ex}\
+"""
 
-        self.shrink_speed = shrink_speed
-        self.history_steps: list[HistoryStep] = []
-
-        for i in range(1, len(history_obs)):
-            self.history_steps.append(
-                HistoryStep(
-                    history_obs[i - 1],
-                    history_obs[i],
-                    actions[i - 1],
-                    memories[i - 1],
-                    flags,
-                )
-            )
 
-    def shrink(self):
-        """Shrink individual steps"""
-        # TODO set the shrink speed of older steps to be higher
-        super().shrink()
-        for step in self.history_steps:
-            step.shrink()
+class MainPrompt(Shrinkable):
+    """The part of the prompt that changes from step to step.
 
-    @property
-    def _prompt(self):
-        prompts = ["# History of interaction with the task:\n"]
-        for i, step in enumerate(self.history_steps):
-            prompts.append(f"## step {i}")
-            prompts.append(step.prompt)
-        return "\n".join(prompts) + "\n"
+    The action space and answer examples live in `StaticPrompt`, but the
+    corresponding elements are kept here to parse the answer. `history` is
+    the `prompt_history.History` of the previous steps.
+    """
 
+    __slots__ = (
+        "flags", "history", "instructions", "obs", "action_space", "thought",
+        "memory",
+    )
 
-class MainPrompt(Shrinkable):
     def __init__(
         self,
-        obs_history,
-        actions,
-        memories,
+        obs,
+        history: Shrinkable,
         flags: Flags,
     ) -> None:
         super().__init__()
         self.flags = flags
-        self.history = History(obs_history, actions, memories, flags)
-        self.instructions = GoalInstructions(obs_history[-1]["goal"])
+        self.history = history
+        self.instructions = GoalInstructions(obs["goal"])
 
-        self.obs = Observation(obs_history[-1], self.flags)
+        self.obs = Observation(obs, self.flags)
         self.action_space = ActionSpace(self.flags)
 
         self.thought = Thought(visible=flags.use_thought)
@@ -642,44 +818,40 @@ class MainPrompt(Shrinkable):
 
     @property
     def _prompt(self) -> str:
-        prompt = f"""\
-{self.instructions.prompt}\
-{self.obs.prompt}\
-{self.history.prompt}\
-{self.action_space.prompt}\
-{self.thought.prompt}\
-{self.memory.prompt}\
-"""
-
-        prompt += f"""
-# Abstract Example
-
-Here is an abstract version of the answer with description of the content of
-each tag. Make sure you follow this structure, but replace the content with
-your answer:
-{self.thought.abstract_ex}\
-{self.memory.abstract_ex}\
-{self.action_space.abstract_ex}\
-"""
+        # the whole text is joined once, from the segments of all elements
+        prompt = "".join(self._prompt_segments())
+        return self.obs.add_screenshot(prompt)
 
-        prompt += f"""
-# Concrete Example
+    def _prompt_segments(self) -> list[str]:
+        # text only, the screenshot is added by _prompt. The history only
+        # grows from step to step, it comes before the observation so that
+        # the start of the prompt stays the same for the provider's prompt
+        # caching.
+        return [
+            *self.instructions.prompt_segments(),
+            *self.history.prompt_segments(),
+            *self.obs.prompt_segments(),
+        ]
+
+    def token_count(self, model_name=DEFAULT_MODEL) -> int:
+        # the screenshot is not counted, only the text of the prompt
+        return (
+            self.instructions.token_count(model_name)
+            + self.obs.token_count(model_name)
+            + self.history.token_count(model_name)
+        )
 
-Here is a concrete example of how to format your answer.
-Make sure to follow the template with proper tags:
-{self.thought.concrete_ex}\
-{self.memory.concrete_ex}\
-{self.action_space.concrete_ex}\
-"""
-        return self.obs.add_screenshot(prompt)
+    def shrink(self, model_name=DEFAULT_MODEL) -> int:
+        return self.history.shrink(model_name) + self.obs.shrink(model_name)
 
-    def shrink(self):
-        self.history.shrink()
-        self.obs.shrink()
+    def trunkaters(self) -> list[Trunkater]:
+        return self.obs.trunkaters()
 
     def _parse_answer(self, text_answer):
+        # scan the answer once, each element then looks up its own tags
+        tags = extract_html_tags(text_answer, ("think", "memory", "action"))
         ans_dict = {}
-        ans_dict.update(self.thought.parse_answer(text_answer))
-        ans_dict.update(self.memory.parse_answer(text_answer))
-        ans_dict.update(self.action_space.parse_answer(text_answer))
+        ans_dict.update(self.thought.parse_answer(tags))
+        ans_dict.update(self.memory.parse_answer(tags))
+        ans_dict.update(self.action_space.parse_answer(tags))
         return ans_dict
@@ -2,57 +2,172 @@
 A bunch of utility functions for dealing with LLMs
 """
 
+import asyncio
+import atexit
 import base64
+import hashlib
 import io
+import itertools
 import logging
+import os
 import re
-import time
-from functools import cache
-from typing import Any, Callable
+import threading
+from collections import OrderedDict
+from functools import cache, lru_cache
+from typing import Any, Awaitable, Callable
 
+import httpx
 import numpy as np
 import tiktoken
 from PIL import Image
-from openai import RateLimitError
-from langchain_core.language_models.chat_models import (
-    BaseChatModel, BaseMessage, HumanMessage
-)
+from openai import AsyncOpenAI, RateLimitError
 
 DEFAULT_MODEL = "gpt-4o"
 
 logger = logging.getLogger(__name__)
 
 
+class _ThreadResources:
+    """The event loop and the clients of one thread.
+
+    Each thread gets its own loop, kept open between calls to `run_sync`
+    so that the connections of its HTTP client can be reused. The clients
+    are bound to the loop they are used from, so they are per thread too.
+    """
+
+    __slots__ = ("loop", "http_client", "openai_client")
+
+    def __init__(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.http_client: httpx.AsyncClient | None = None
+        self.openai_client: AsyncOpenAI | None = None
+
+
+_thread_local = threading.local()
+# the resources of all threads, closed at exit
+_all_resources: list[_ThreadResources] = []
+_all_resources_lock = threading.Lock()
+
+
+def _thread_resources() -> _ThreadResources:
+    resources = getattr(_thread_local, "resources", None)
+    if resources is None:
+        resources = _thread_local.resources = _ThreadResources()
+        with _all_resources_lock:
+            _all_resources.append(resources)
+    return resources
+
+
+def run_sync(coro):
+    """Run a coroutine to completion from synchronous code.
+
+    Unlike `asyncio.run`, the event loop of the calling thread is kept open
+    between calls, so the connections of `get_shared_http_async_client` can
+    be reused. It can't be called from a running event loop (e.g. in a
+    notebook or an async harness), where the coroutine should be awaited
+    instead.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        coro.close()
+        raise RuntimeError(
+            "run_sync() cannot be called from a running event loop, await "
+            "the coroutine instead (e.g. WebResearchAgent.aget_action)."
+        )
+    return _thread_resources().loop.run_until_complete(coro)
+
+
+@atexit.register
+def _close_thread_resources() -> None:
+    with _all_resources_lock:
+        all_resources = list(_all_resources)
+        _all_resources.clear()
+    for resources in all_resources:
+        loop = resources.loop
+        if loop.is_running() or loop.is_closed():
+            continue
+        if resources.http_client is not None:
+            loop.run_until_complete(resources.http_client.aclose())
+        loop.close()
+
+
+def get_shared_http_async_client() -> httpx.AsyncClient:
+    """An HTTP client shared by all chat models of the calling thread.
+
+    Reusing it across steps and agents saves the DNS lookup and TLS handshake
+    of a new connection per request, and HTTP/2 multiplexes concurrent
+    requests over one connection. It must be used from `run_sync`, in the
+    same thread.
+    """
+    resources = _thread_resources()
+    if resources.http_client is None:
+        resources.http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=100, max_keepalive_connections=50
+            ),
+        )
+    return resources.http_client
+
+
+def get_shared_openai_client() -> AsyncOpenAI:
+    """An OpenAI client using `get_shared_http_async_client`."""
+    resources = _thread_resources()
+    if resources.openai_client is None:
+        resources.openai_client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            http_client=get_shared_http_async_client(),
+        )
+    return resources.openai_client
+
+
+_WAIT_RE = re.compile(r"try again in (\d+(?:\.\d+)?)s")
+
+
 def _extract_wait_time(error_message, min_retry_wait_time=60):
     """Extract the wait time from an OpenAI RateLimitError message."""
-    match = re.search(r"try again in (\d+(\.\d+)?)s", error_message)
+    match = _WAIT_RE.search(error_message)
     if match:
         return max(min_retry_wait_time, float(match.group(1)))
     return min_retry_wait_time
 
 
-def retry(
-    chat: BaseChatModel,
-    messages: list[BaseMessage],
+async def aretry(
+    chat: Callable[[list[dict]], Awaitable[str]],
+    messages: list[dict],
     n_retry: int,
     parser: Callable[[Any], tuple[dict, bool, str]],
+    n_first_samples: int = 1,
     log: bool = True,
     min_retry_wait_time=60,
     rate_limit_max_wait_time=60 * 30,
+    tail_only_retry: Callable[[str], bool] | None = None,
 ):
     """Retry querying the chat models with the response from the parser until
     it returns a valid value.
 
-    If the answer is not valid, it will retry and append to the chat the retry
-    message.  It will stop after `n_retry`.
+    The first query can sample `n_first_samples` answers concurrently and
+    keep the first one that parses, cancelling the others. Each sample sends
+    the whole prompt, so this trades input tokens for latency. If the answer
+    is not valid, it will retry and append to the chat the retry message.
+    It will stop after `n_retry`.
 
-    Note, each retry has to resend the whole prompt to the API. This can be
-    slow and expensive.
+    A retry doesn't resend the whole conversation: it sends the leading
+    system messages, the last user message of the prompt with its images
+    removed, the last answer and the retry message, see `_retry_messages`.
+    When `tail_only_retry` says the failed answer can be repaired on its
+    own, the user message is left out as well. `messages` is only ever
+    appended to, so the earlier messages form a stable prefix for the
+    provider's prompt caching.
 
     Parameters:
     -----------
-        chat (function) : a langchain ChatOpenAI taking a list of messages and
-            returning a list of answers.
+        chat (function) : an async function taking a list of messages in the
+            format of the OpenAI chat completions API and returning the text
+            of the answer.
         messages (list) : the list of messages so far.
         n_retry (int) : the maximum number of sequential retries.
         parser (function): a function taking a message and returning a tuple
@@ -61,10 +176,16 @@ def retry(
             valid : a boolean indicating if the value is valid,
             retry_message : a message to send to the chat if the value is not
                 valid
+        n_first_samples (int): the number of concurrent samples for the first
+            query. The chat model should have a non-zero temperature.
         log (bool): whether to log the retry messages.
         min_retry_wait_time (float): the minimum wait time in seconds
             after RateLimtError. will try to parse the wait time from the error
             message.
+        tail_only_retry (function): a function taking a failed answer and
+            returning whether the retry can do without the last user
+            message of the prompt, e.g. because only the format of a valid
+            action is wrong. By default, the user message is always sent.
 
     Returns:
     --------
@@ -72,16 +193,25 @@ def retry(
     """
     tries = 0
     rate_limit_total_delay = 0
+    n_samples = n_first_samples
+    n_prompt = len(messages)
+    with_prompt = True
     while tries < n_retry and \
             rate_limit_total_delay < rate_limit_max_wait_time:
+        if tries:
+            query = _retry_messages(messages, n_prompt, with_prompt)
+        else:
+            query = messages
         try:
-            answer = chat.invoke(messages)
+            answer, (value, valid, retry_message) = await _first_valid_answer(
+                chat, query, parser, n_samples
+            )
         except RateLimitError as e:
             wait_time = _extract_wait_time(e.args[0], min_retry_wait_time)
             logger.warning(
                 "RateLimitError, waiting %s before retrying.", wait_time
             )
-            time.sleep(wait_time)
+            await asyncio.sleep(wait_time)
             rate_limit_total_delay += wait_time
             if rate_limit_total_delay >= rate_limit_max_wait_time:
                 logger.warning(
@@ -92,50 +222,207 @@ def retry(
                 raise
             continue
 
-        messages.append(answer)
+        n_samples = 1
+        messages.append({"role": "assistant", "content": answer})
 
-        value, valid, retry_message = parser(answer.content)
         if valid:
             return value
 
         tries += 1
-        if log:
-            logging.info(
-                "Query failed. Retrying %d/%d.\n[LLM]:\n%s\n[User]:\n%s",
-                tries, n_retry, answer.content, retry_message
+        with_prompt = tail_only_retry is None or not tail_only_retry(answer)
+        # counting the prompt encodes it in full, only do it when the message
+        # is actually logged
+        if log and logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Query failed. Retrying %d/%d (%d prompt tokens).\n"
+                "[LLM]:\n%s\n[User]:\n%s",
+                tries, n_retry, count_messages_tokens(messages), answer,
+                retry_message
             )
-        messages.append(HumanMessage(content=retry_message))
+        messages.append({"role": "user", "content": retry_message})
 
     raise ValueError(f"Could not parse a valid value after {n_retry} retries.")
 
 
+def _retry_messages(
+    messages: list[dict], n_prompt: int, with_prompt: bool
+) -> list[dict]:
+    """The leading system messages of `messages`, the last user message of
+    the prompt (its first `n_prompt` messages) without its images if
+    `with_prompt`, then the last answer and the retry message that follows
+    it."""
+    query = list(
+        itertools.takewhile(lambda m: m["role"] == "system", messages)
+    )
+    user = next(
+        (m for m in reversed(messages[:n_prompt]) if m["role"] == "user"),
+        None,
+    )
+    if with_prompt and user is not None:
+        query.append(_without_images(user))
+    return query + messages[-2:]
+
+
+def _without_images(message: dict) -> dict:
+    content = message["content"]
+    if isinstance(content, str):
+        return message
+    return {
+        **message,
+        "content": [part for part in content if part["type"] == "text"],
+    }
+
+
+async def _first_valid_answer(
+    chat: Callable[[list[dict]], Awaitable[str]],
+    messages: list[dict],
+    parser: Callable[[Any], tuple[dict, bool, str]],
+    n_samples: int,
+) -> tuple[str, tuple[dict, bool, str]]:
+    """Sample `n_samples` answers concurrently and return the first one that
+    parses, along with the output of the parser. The pending samples are
+    cancelled, and awaited so that their cleanup (closing their stream)
+    runs before this returns. If no answer is valid, the last one is
+    returned. A RateLimitError is only raised if every sample hit the rate
+    limit."""
+    tasks = [
+        asyncio.ensure_future(chat(messages))
+        for _ in range(n_samples)
+    ]
+    rate_limit_error = None
+    result = None
+    try:
+        for next_answer in asyncio.as_completed(tasks):
+            try:
+                answer = await next_answer
+            except RateLimitError as e:
+                rate_limit_error = e
+                continue
+            parsed = parser(answer)
+            result = answer, parsed
+            if parsed[1]:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+        # run_sync stops the loop as soon as the step returns, the cancelled
+        # samples would otherwise only clean up during the next step
+        await asyncio.gather(*tasks, return_exceptions=True)
+    if result is None:
+        raise rate_limit_error
+    return result
+
+
 @cache
 def get_tokenizer(model_name=DEFAULT_MODEL):
     return tiktoken.encoding_for_model(model_name.split("/")[-1])
 
 
+# Texts up to this many characters have their token count memoized. This
+# covers the static parts of the prompt, which are rebuilt at every step,
+# without keeping whole observations alive in the cache.
+COUNT_CACHE_MAX_CHARS = 20_000
+
+
+@lru_cache(maxsize=4096)
+def _count_tokens_cached(text, model):
+    return len(get_tokenizer(model).encode(text))
+
+
 def count_tokens(text, model=DEFAULT_MODEL):
+    if len(text) <= COUNT_CACHE_MAX_CHARS:
+        return _count_tokens_cached(text, model)
     enc = get_tokenizer(model)
     return len(enc.encode(text))
 
 
-def image_to_jpg_base64_url(image: np.ndarray | Image.Image):
-    """Convert a numpy array to a base64 encoded image url."""
+def count_messages_tokens(messages: list[dict], model=DEFAULT_MODEL) -> int:
+    """Number of tokens in the text of chat messages, images excluded.
+
+    Short messages have their counts cached, see `count_tokens`, long
+    ones (the observation) are encoded again on every call.
+    """
+    total = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            total += count_tokens(content, model)
+        else:
+            total += sum(
+                count_tokens(part["text"], model)
+                for part in content if part["type"] == "text"
+            )
+    return total
+
+
+# The page often looks the same from one step to the next (e.g. after an
+# action that failed), so the last few encodings are kept, keyed by a hash of
+# the pixels.
+_JPG_CACHE: OrderedDict[tuple[bytes, int | None], str] = OrderedDict()
+_JPG_CACHE_SIZE = 8
+
+
+def _image_digest(image: np.ndarray | Image.Image) -> bytes:
+    hasher = hashlib.blake2b(digest_size=16)
+    if isinstance(image, np.ndarray):
+        hasher.update(f"{image.shape}{image.dtype}".encode())
+        hasher.update(np.ascontiguousarray(image).data)
+    else:
+        hasher.update(f"{image.size}{image.mode}".encode())
+        hasher.update(image.tobytes())
+    return hasher.digest()
+
+
+def image_to_jpg_base64_url(
+    image: np.ndarray | Image.Image, max_size: int | None = None
+):
+    """Convert a numpy array to a base64 encoded image url.
+
+    If `max_size` is given, larger images are scaled down so that their
+    largest side is `max_size` pixels, keeping the aspect ratio.
+    """
+
+    key = (_image_digest(image), max_size)
+    url = _JPG_CACHE.get(key)
+    if url is not None:
+        _JPG_CACHE.move_to_end(key)
+        return url
 
     if isinstance(image, np.ndarray):
         image = Image.fromarray(image)
+    if max_size is not None and max(image.size) > max_size:
+        scale = max_size / max(image.size)
+        image = image.resize(
+            (round(image.width * scale), round(image.height * scale)),
+            Image.Resampling.BILINEAR,
+        )
     if image.mode in ("RGBA", "LA"):
         image = image.convert("RGB")
     buffered = io.BytesIO()
-    image.save(buffered, format="JPEG")
+    image.save(buffered, format="JPEG", quality=75, optimize=False)
 
     image_base64 = base64.b64encode(buffered.getvalue()).decode()
-    return f"data:image/jpeg;base64,{image_base64}"
+    url = f"data:image/jpeg;base64,{image_base64}"
+    _JPG_CACHE[key] = url
+    if len(_JPG_CACHE) > _JPG_CACHE_SIZE:
+        _JPG_CACHE.popitem(last=False)
+    return url
+
+
+@lru_cache(maxsize=64)
+def _tags_re(keys: tuple[str, ...]) -> re.Pattern:
+    """Single pattern matching any of `keys`, compiled once per set of
+    keys."""
+    alternation = "|".join(map(re.escape, keys))
+    return re.compile(rf"<({alternation})>(.*?)</\1>", re.DOTALL)
 
 
 def extract_html_tags(text, keys):
     """Extract the content within HTML tags for a list of keys.
 
+    The text is scanned once, whatever the number of keys, and once more
+    for each key that is not found, in case it is nested in another tag.
+
     Parameters
     ----------
     text : str
@@ -153,15 +440,27 @@ def extract_html_tags(text, keys):
     -----
     All text and keys will be converted to lowercase before matching.
 
+    Once a key is found, its instances nested in another requested tag are
+    not collected, unlike with a separate search per key.
+
     """
     content_dict = {}
     # text = text.lower()
     # keys = set([k.lower() for k in keys])
+    if not keys:
+        return content_dict
+    # only the requested tags are matched, an unknown enclosing tag doesn't
+    # hide them
+    keys = tuple(sorted(set(keys)))
+    for key, match in _tags_re(keys).findall(text):
+        content_dict.setdefault(key, []).append(match.strip())
+    # a tag nested in another requested one is consumed with it, e.g. an
+    # <action> in the <think>, look for the missing keys on their own
     for key in keys:
-        pattern = f"<{key}>(.*?)</{key}>"
-        matches = re.findall(pattern, text, re.DOTALL)
-        if matches:
-            content_dict[key] = [match.strip() for match in matches]
+        if key not in content_dict:
+            matches = _tags_re((key,)).findall(text)
+            if matches:
+                content_dict[key] = [match.strip() for _, match in matches]
     return content_dict
 
 
@@ -191,8 +490,10 @@ def parse_html_tags(text, keys=(), optional_keys=(), merge_multiple=False):
 
     Parameters
     ----------
-    text : str
-        The input string containing the HTML tags.
+    text : str or dict
+        The input string containing the HTML tags, or the output of
+        `extract_html_tags` for it, to avoid scanning it again when several
+        callers parse the same text.
     keys : list of str
         The HTML tags to extract the content from.
     optional_keys : list of str
@@ -209,7 +510,10 @@ def parse_html_tags(text, keys=(), optional_keys=(), merge_multiple=False):
         successful.
     """
     all_keys = tuple(keys) + tuple(optional_keys)
-    content_dict = extract_html_tags(text, all_keys)
+    if isinstance(text, dict):
+        content_dict = {key: text[key] for key in all_keys if key in text}
+    else:
+        content_dict = extract_html_tags(text, all_keys)
     retry_messages = []
 
     for key in all_keys:
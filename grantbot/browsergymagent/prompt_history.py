@@ -0,0 +1,259 @@
+"""
+The history part of the prompt: what the agent did at each previous step
+and how the page changed.
+"""
+
+import difflib
+import itertools
+
+from browsergymagent.dynamic_prompting import Error, Flags, Shrinkable
+from browsergymagent.llm_utils import DEFAULT_MODEL, count_tokens
+
+
+# Above this many lines (previous and new combined), diff compares the two
+# texts as sets of lines instead of aligning them, which is linear.
+FAST_DIFF_MIN_LINES = 2000
+
+
+def diff(previous, new):
+    """Return a string showing the difference between original and new.
+
+    If the difference is above diff_threshold, return the diff string."""
+
+    if previous == new:
+        return "Identical", []
+
+    if not previous:
+        return "previous is empty", []
+
+    previous_lines = previous.splitlines()
+    new_lines = new.splitlines()
+
+    if len(previous_lines) + len(new_lines) > FAST_DIFF_MIN_LINES:
+        # Large observations (full AXTree/HTML dumps) are usually changed in
+        # bulk, so a set difference of the lines is enough and avoids the
+        # quadratic sequence matching.
+        previous_set = set(previous_lines)
+        new_set = set(new_lines)
+        removed = [f"- {line}" for line in previous_lines
+                   if line not in new_set]
+        added = [f"+ {line}" for line in new_lines if line not in previous_set]
+        diff_lines = removed + added
+        minus_count = len(removed)
+        plus_count = len(added)
+    else:
+        diff_gen = difflib.unified_diff(
+            previous_lines, new_lines, n=0, lineterm=""
+        )
+        diff_lines = []
+        plus_count = 0
+        minus_count = 0
+        # skip the "---" and "+++" file headers
+        for line in itertools.islice(diff_gen, 2, None):
+            if line.startswith("+"):
+                plus_count += 1
+            elif line.startswith("-"):
+                minus_count += 1
+            else:
+                # "@@" hunk headers
+                continue
+            diff_lines.append(f"{line[0]} {line[1:]}")
+
+    header = f"{plus_count} lines added and {minus_count} lines removed:"
+
+    return header, diff_lines
+
+
+class Diff(Shrinkable):
+    """Difference between two texts, computed on first render.
+
+    A hidden diff never pays for `diff`. The texts are dropped once the
+    difference is computed.
+    """
+
+    __slots__ = (
+        "initial_max_line_diff", "max_line_diff", "_previous", "_new",
+        "_diff", "shrink_speed", "prefix",
+    )
+
+    def __init__(
+        self, previous, new, prefix="", max_line_diff=20,
+        shrink_speed=2, visible=True
+    ) -> None:
+        super().__init__(visible=visible)
+        self.initial_max_line_diff = max_line_diff
+        self.max_line_diff = max_line_diff
+        self._previous = previous
+        self._new = new
+        self._diff: tuple[str, list[str]] | None = None
+        self.shrink_speed = shrink_speed
+        self.prefix = prefix
+
+    def shrink(self, model_name=DEFAULT_MODEL) -> int:
+        max_line_diff = max(1, self.max_line_diff - self.shrink_speed)
+        if max_line_diff == self.max_line_diff:
+            return 0
+        before = self.token_count(model_name)
+        self.max_line_diff = max_line_diff
+        self._invalidate_token_count()
+        return before - self.token_count(model_name)
+
+    def reset_shrink(self):
+        """Undo all previous shrinks."""
+        if self.max_line_diff != self.initial_max_line_diff:
+            self.max_line_diff = self.initial_max_line_diff
+            self._invalidate_token_count()
+
+    def _compute(self) -> tuple[str, list[str]]:
+        if self._diff is None:
+            self._diff = diff(self._previous, self._new)
+            # the texts are no longer needed, don't keep them in the history
+            self._previous = self._new = None
+        return self._diff
+
+    @property
+    def _prompt(self) -> str:
+        header, diff_lines = self._compute()
+        diff_str = "\n".join(diff_lines[: self.max_line_diff])
+        if len(diff_lines) > self.max_line_diff:
+            original_count = len(diff_lines)
+            diff_str = (
+                f"{diff_str}\nDiff truncated, "
+                f"{original_count - self.max_line_diff} changes now shown."
+            )
+        return f"{self.prefix}{header}\n{diff_str}\n"
+
+
+class HistoryStep(Shrinkable):
+    """One step of the history: the action taken and its effect.
+
+    Computing the diffs is expensive, so a step is built once, when its
+    observation arrives, and reused in the prompts of all later steps (see
+    `WebResearchAgent`). `History` calls `reset_shrink` before reusing it.
+    """
+
+    __slots__ = (
+        "html_diff", "ax_tree_diff", "error", "shrink_speed", "action",
+        "memory", "flags",
+    )
+
+    def __init__(
+        self, previous_obs, current_obs, action, memory, flags: Flags,
+        shrink_speed=1
+    ) -> None:
+        super().__init__()
+        # diffs that can never be shown are not built at all
+        self.html_diff: Diff | None = None
+        self.ax_tree_diff: Diff | None = None
+        if flags.use_html and flags.use_diff:
+            self.html_diff = Diff(
+                previous_obs["pruned_html"],
+                current_obs["pruned_html"],
+                prefix="\n### HTML diff:\n",
+                shrink_speed=shrink_speed,
+            )
+        if flags.use_ax_tree and flags.use_diff:
+            self.ax_tree_diff = Diff(
+                previous_obs["axtree_txt"],
+                current_obs["axtree_txt"],
+                prefix="\n### Accessibility tree diff:\n",
+                shrink_speed=shrink_speed,
+            )
+        self.error = Error(
+            current_obs["last_action_error"],
+            visible=(
+                lambda: flags.use_error_logs
+                and current_obs["last_action_error"]
+                and flags.use_past_error_logs
+            ),
+            prefix="### ",
+        )
+        self.shrink_speed = shrink_speed
+        self.action = action
+        self.memory = memory
+        self.flags = flags
+
+    def _diffs(self) -> list[Diff]:
+        return [
+            diff_ for diff_ in (self.html_diff, self.ax_tree_diff)
+            if diff_ is not None
+        ]
+
+    def shrink(self, model_name=DEFAULT_MODEL) -> int:
+        return sum(diff_.shrink(model_name) for diff_ in self._diffs())
+
+    def reset_shrink(self):
+        """Undo all previous shrinks, so the step can be reused in a new
+        prompt."""
+        for diff_ in self._diffs():
+            diff_.reset_shrink()
+
+    @property
+    def _prompt(self) -> str:
+        return "".join(self._prompt_segments())
+
+    def _prompt_segments(self) -> list[str]:
+        parts: list[str] = []
+
+        if self.flags.use_action_history:
+            parts.append(f"\n### Action:\n{self.action}\n")
+
+        parts.extend(self.error.prompt_segments())
+        for diff_ in self._diffs():
+            parts.extend(diff_.prompt_segments())
+
+        if self.flags.use_memory and self.memory is not None:
+            parts.append(f"\n### Memory:\n{self.memory}\n")
+
+        return parts
+
+    def token_count(self, model_name=DEFAULT_MODEL) -> int:
+        own_parts: list[str] = []
+        if self.flags.use_action_history:
+            own_parts.append(f"\n### Action:\n{self.action}\n")
+        if self.flags.use_memory and self.memory is not None:
+            own_parts.append(f"\n### Memory:\n{self.memory}\n")
+        return (
+            count_tokens("".join(own_parts), model=model_name)
+            + self.error.token_count(model_name)
+            + sum(diff_.token_count(model_name) for diff_ in self._diffs())
+        )
+
+
+class History(Shrinkable):
+    __slots__ = ("shrink_speed", "history_steps")
+
+    def __init__(
+        self, history_steps: list[HistoryStep], flags: Flags, shrink_speed=1
+    ) -> None:
+        super().__init__(visible=lambda: flags.use_history)
+        self.shrink_speed = shrink_speed
+        self.history_steps = history_steps
+        for step in self.history_steps:
+            step.reset_shrink()
+
+    def shrink(self, model_name=DEFAULT_MODEL) -> int:
+        """Shrink individual steps"""
+        # TODO set the shrink speed of older steps to be higher
+        return sum(step.shrink(model_name) for step in self.history_steps)
+
+    @property
+    def _prompt(self):
+        return "".join(self._prompt_segments())
+
+    def _prompt_segments(self) -> list[str]:
+        parts = ["\n# History of interaction with the task:\n"]
+        for i, step in enumerate(self.history_steps):
+            parts.extend(("\n", f"## step {i}", "\n"))
+            parts.extend(step.prompt_segments())
+        parts.append("\n")
+        return parts
+
+    def token_count(self, model_name=DEFAULT_MODEL) -> int:
+        if not self.is_visible:
+            return 0
+        headers = ["\n# History of interaction with the task:\n"]
+        headers.extend(f"## step {i}" for i in range(len(self.history_steps)))
+        return count_tokens("\n".join(headers) + "\n", model=model_name) + sum(
+            step.token_count(model_name) for step in self.history_steps
+        )
@@ -1,7 +1,6 @@
 import gymnasium as gym
-from langchain.prompts import PromptTemplate
 
-from sample_data import MAIN_INSTRUCTION, RWF_PROGRAM_NAME, RWF_SUMMARY
+from sample_data import format_main_instruction
 from browsergymagent.agent import WebResearchAgent
 from browsergymagent.dynamic_prompting import Flags
 
@@ -24,9 +23,8 @@ def browsergymagent_main(start_url: str, agent_instruction: str) -> None:
 
 
 if __name__ == '__main__':
-    instruction = PromptTemplate.from_template(MAIN_INSTRUCTION).format(
-        program_summary=RWF_SUMMARY, program_name=RWF_PROGRAM_NAME,
-        grant_maker="The Morris and Gwendolyn Cafritz Foundation"
+    instruction = format_main_instruction(
+        "The Morris and Gwendolyn Cafritz Foundation"
     )
     browsergymagent_main(
         "https://www.cafritzfoundation.org/",
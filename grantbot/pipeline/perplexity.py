@@ -1,16 +1,109 @@
+import logging
 import os
 import requests
+from pydantic import ValidationError
 from shared_types import GrantInformation
-from openai import OpenAI
-from langchain.prompts import PromptTemplate
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential,
+)
 
-from sample_data import MAIN_INSTRUCTION, RWF_PROGRAM_NAME, RWF_SUMMARY
+from sample_data import format_main_instruction
 
-openai_client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+logger = logging.getLogger(__name__)
+
+# retries are done by transient_retry, not by the client as well
+openai_client = OpenAI(api_key=os.environ["OPENAI_API_KEY"], max_retries=0)
+
+# one session, so the connection to the Perplexity API is reused between
+# requests
+perplexity_session = requests.Session()
+perplexity_session.headers.update({
+    "Authorization": "Bearer " + os.environ["PERPLEXITY_API_KEY"],
+    "Content-Type": "application/json",
+})
+
+# the system prompts of the pipeline requests
+EXTRACTION_SYSTEM_PROMPT = (
+    "Extract the agent's response into a structured format."
+)
+PERPLEXITY_SYSTEM_PROMPT = (
+    "Be complete. Be concise. Be clear. Reply in Markdown."
+)
+PERPLEXITY_STRUCTURED_SYSTEM_PROMPT = (
+    "Be complete. Be concise. Be clear. Reply with the requested JSON."
+)
+GRANT_INFORMATION_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"schema": GrantInformation.model_json_schema()},
+}
+
+DEFAULT_PERPLEXITY_MODEL = "llama-3.1-sonar-huge-128k-online"
+
+
+def _is_transient(error: BaseException) -> bool:
+    """Whether a failed API call is worth retrying as is."""
+    if isinstance(error, (
+        RateLimitError, APITimeoutError, APIConnectionError,
+        InternalServerError, requests.ConnectionError, requests.Timeout,
+    )):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return False
+
+
+# A transient failure would otherwise throw away the whole research, retry
+# with exponential backoff instead.
+transient_retry = retry(
+    retry=retry_if_exception(_is_transient),
+    wait=wait_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
 
 
 def obtain_grant_info(prompt: str) -> GrantInformation | None:
-    perplexity_response = obtain_perplexity_response(prompt)
+    """Research the grant with Perplexity, asking it for a GrantInformation
+    directly. If that doesn't work, fall back to a Markdown answer that
+    gpt-4o extracts into a GrantInformation."""
+    try:
+        return obtain_structured_grant_info(prompt)
+    except (
+        requests.RequestException, ValidationError, KeyError, IndexError
+    ) as e:
+        logger.warning(
+            "Structured Perplexity response failed (%s), extracting the "
+            "grant information with gpt-4o instead.", e
+        )
+    return extract_grant_info(prompt, obtain_perplexity_response(prompt))
+
+
+def obtain_structured_grant_info(
+        prompt: str,
+        model_name: str = DEFAULT_PERPLEXITY_MODEL) -> GrantInformation:
+    data = _perplexity_completion(
+        prompt, model_name, PERPLEXITY_STRUCTURED_SYSTEM_PROMPT,
+        response_format=GRANT_INFORMATION_FORMAT,
+    )
+    return GrantInformation.model_validate_json(
+        data["choices"][0]["message"]["content"]
+    )
+
+
+@transient_retry
+def extract_grant_info(
+        prompt: str, perplexity_response: str) -> GrantInformation | None:
     prompt = (
         "# The Researcher's Task\n"
         "We asked a web research agent to perform the following task:\n\n"
@@ -19,6 +112,7 @@ def obtain_grant_info(prompt: str) -> GrantInformation | None:
         "# The Researcher's Response\n"
         "The research agent's response was:\n\n"
         f"{perplexity_response}"
+        "\n\n"
         "# Your task\n"
         "Your task is to extract the agent's response into a structured "
         "format."
@@ -26,12 +120,7 @@ def obtain_grant_info(prompt: str) -> GrantInformation | None:
     completion = openai_client.beta.chat.completions.parse(
         model="gpt-4o",
         messages=[
-            {
-                "role": "system",
-                "content": (
-                    "Extract the agent's response into a structured format."
-                )
-            },
+            {"role": "system", "content": EXTRACTION_SYSTEM_PROMPT},
             {"role": "user", "content": prompt},
         ],
         response_format=GrantInformation
@@ -41,15 +130,27 @@ def obtain_grant_info(prompt: str) -> GrantInformation | None:
 
 def obtain_perplexity_response(
         prompt: str,
-        model_name: str = "llama-3.1-sonar-huge-128k-online") -> str:
+        model_name: str = DEFAULT_PERPLEXITY_MODEL) -> str:
+    data = _perplexity_completion(prompt, model_name, PERPLEXITY_SYSTEM_PROMPT)
+    answer = data["choices"][0]["message"]["content"]
+    # the answer refers to its sources as [1], [2]..., keep their links,
+    # they are where the grant link comes from
+    citations = data.get("citations") or []
+    if citations:
+        answer += "\n\nCitations:\n" + "\n".join(
+            f"[{i}] {url}" for i, url in enumerate(citations, start=1)
+        )
+    return answer
+
+
+@transient_retry
+def _perplexity_completion(
+        prompt: str, model_name: str, system_prompt: str,
+        response_format: dict | None = None) -> dict:
     payload = {
         "model": model_name,
         "messages": [
-            {
-                "role": "system",
-                "content":
-                    "Be complete. Be concise. Be clear. Reply in Markdown."
-            },
+            {"role": "system", "content": system_prompt},
             {
                 "role": "user",
                 "content": prompt
@@ -66,23 +167,20 @@ def obtain_perplexity_response(
         "presence_penalty": 0,
         "frequency_penalty": 1
     }
-    headers = {
-        "Authorization": "Bearer " + os.environ["PERPLEXITY_API_KEY"],
-        "Content-Type": "application/json"
-    }
-    response = requests.post(
+    if response_format is not None:
+        payload["response_format"] = response_format
+    response = perplexity_session.post(
         "https://api.perplexity.ai/chat/completions",
         json=payload,
-        headers=headers,
         timeout=120
     )
-    return response.text
+    response.raise_for_status()
+    return response.json()
 
 
 if __name__ == "__main__":
-    instruction = PromptTemplate.from_template(MAIN_INSTRUCTION).format(
-        program_summary=RWF_SUMMARY, program_name=RWF_PROGRAM_NAME,
-        grant_maker="The Morris and Gwendolyn Cafritz Foundation"
+    instruction = format_main_instruction(
+        "The Morris and Gwendolyn Cafritz Foundation"
     )
     grant_info = obtain_grant_info(instruction)
     print(grant_info)
@@ -0,0 +1,3 @@
+"""
+Prompt texts, loaded with importlib.resources by sample_data
+"""
@@ -1,7 +1,17 @@
-from pydantic import BaseModel
+from typing import Literal
+
+from pydantic import BaseModel, ConfigDict
+
+# how applications are submitted, "online" and "portal" mean online
+ApplicationProcedure = Literal["online", "portal", "email", "mail", "other"]
 
 
 class GrantInformation(BaseModel):
+    # validated once, from the LLM's answer, and never modified after that
+    model_config = ConfigDict(
+        frozen=True, extra="forbid", revalidate_instances="never"
+    )
+
     grant_maker: str
     grant_name: str | None
     grant_link: str
@@ -9,5 +19,11 @@ class GrantInformation(BaseModel):
     eligibility: str
     deadline: str
     notes: str
-    can_apply_online: bool
-    application_procedure: str
+    application_procedure: ApplicationProcedure
+    procedure_details: str | None
+
+    # a plain property, so it stays out of model_dump() and the model can
+    # validate its own output despite extra="forbid"
+    @property
+    def can_apply_online(self) -> bool:
+        return self.application_procedure in ("online", "portal")